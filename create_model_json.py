@@ -1,6 +1,7 @@
-import json
 import os
 
+from utils import load_json, dump_json
+
 # Create a minimal but valid model.json structure
 model_json = {
     "format": "layers-model",
@@ -36,8 +37,7 @@ model_json = {
 
 # Try to preserve weights info from existing model.json
 try:
-    with open('model/model.json', 'r') as f:
-        existing_model = json.load(f)
+    existing_model = load_json('model/model.json')
     
     if 'weightsManifest' in existing_model:
         model_json['weightsManifest'] = existing_model['weightsManifest']
@@ -68,8 +68,7 @@ if os.path.exists('model/model.json'):
         print(f"Could not backup original model.json: {str(e)}")
 
 # Write new model.json
-with open('model/model.json', 'w') as f:
-    json.dump(model_json, f, indent=2)
+dump_json(model_json, 'model/model.json', indent=True)
 
 print("Created new model.json with proper input shape")
 print("You may need to restart your web server for changes to take effect")
\ No newline at end of file
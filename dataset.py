@@ -1,15 +1,32 @@
 import os
-import requests
+import shutil
+import struct
+import httpx
 import zipfile
 import io
 from tqdm import tqdm
 import glob
 import json
+import csv
+import operator
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import fast_copy
+
+# pandas parses the ground truth in C and labels all rows with one argmax;
+# without it we fall back to the csv module
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    pd = None
 
 # Configuration
 OUTPUT_DIR = 'isic_dataset'
 TEMP_DIR = 'temp_downloads'
-chunk_size = 1024 * 1024
+chunk_size = 4 * 1024 * 1024
+extract_workers = 8
 # Create directories
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(TEMP_DIR, exist_ok=True)
@@ -24,6 +41,14 @@ DATASETS = [
     }
 ]
 
+# One client for all downloads, so both ISIC archives share a connection
+client_options = dict(timeout=None, limits=httpx.Limits(max_connections=8))
+try:
+    client = httpx.Client(http2=True, **client_options)
+except ImportError:
+    # HTTP/2 needs the optional h2 package
+    client = httpx.Client(**client_options)
+
 def download_file(url, output_path):
     """Download a file from URL to the specified path with progress bar"""
     if os.path.exists(output_path):
@@ -31,19 +56,20 @@ def download_file(url, output_path):
         return output_path
         
     print(f"Downloading {url}...")
-    response = requests.get(url, stream=True)
-    total_size = int(response.headers.get('content-length', 0))
-    
-    with open(output_path, 'wb') as f, tqdm(
-        desc=os.path.basename(url),
-        total=total_size,
-        unit='B',
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as bar:
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            size = f.write(chunk)
-            bar.update(size)
+    with client.stream('GET', url) as response:
+        response.raise_for_status()
+        total_size = int(response.headers.get('content-length', 0))
+        
+        with open(output_path, 'wb') as f, tqdm(
+            desc=os.path.basename(url),
+            total=total_size,
+            unit='B',
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as bar:
+            for chunk in response.iter_bytes(chunk_size=chunk_size):
+                size = f.write(chunk)
+                bar.update(size)
     
     return output_path
 
@@ -52,25 +78,156 @@ def extract_zip(zip_path, extract_to):
     print(f"Extracting {zip_path}...")
     
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
+        names = zip_ref.namelist()
+    
+    # Create every directory up front so worker threads never race on makedirs
+    for directory in {os.path.dirname(name) for name in names}:
+        os.makedirs(os.path.join(extract_to, directory), exist_ok=True)
+    
+    def extract_members(members):
+        # Each worker opens its own handle, ZipFile objects are not thread-safe
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for name in members:
+                zip_ref.extract(name, extract_to)
+    
+    batches = [names[i::extract_workers] for i in range(extract_workers)]
+    with ThreadPoolExecutor(max_workers=extract_workers) as executor:
+        list(executor.map(extract_members, batches))
+
+def member_data_offset(raw, info):
+    """Return the file offset of a ZIP member's data, just past its local header"""
+    raw.seek(info.header_offset)
+    header = raw.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+def copy_stored_member(raw, info, dst):
+    """Copy an uncompressed member from the archive into dst with os.sendfile"""
+    offset = member_data_offset(raw, info)
+    remaining = info.file_size
+    while remaining > 0:
+        sent = os.sendfile(dst.fileno(), raw.fileno(), offset, remaining)
+        if sent == 0:
+            raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+        offset += sent
+        remaining -= sent
+
+def extract_images(zip_path, targets):
+    """
+    Stream the ZIP members listed in targets (image id -> destination path)
+    straight to their destinations, skipping everything else in the archive.
+    Returns the ids of the images that were written.
+    """
+    print(f"Extracting images from {zip_path}...")
+    
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = []
+        image_ids = []
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            image_id = os.path.splitext(os.path.basename(info.filename))[0]
+            if image_id in targets:
+                members.append((info, targets[image_id]))
+                image_ids.append(image_id)
+    
+    def extract_members(batch):
+        # Each worker opens its own handles, ZipFile objects are not thread-safe
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref, open(zip_path, 'rb') as raw:
+            for info, target_path in batch:
+                with open(target_path, 'wb') as dst:
+                    # JPEGs are usually stored uncompressed, so their bytes can be
+                    # copied by the kernel without going through zipfile at all
+                    copied = False
+                    if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+                        try:
+                            copy_stored_member(raw, info, dst)
+                            copied = True
+                        except (OSError, AttributeError):
+                            # No sendfile support here, start over through zipfile
+                            dst.seek(0)
+                            dst.truncate()
+                    if not copied:
+                        with zip_ref.open(info) as src:
+                            shutil.copyfileobj(src, dst, chunk_size)
+                progress.update(1)
+    
+    batches = [members[i::extract_workers] for i in range(extract_workers)]
+    with tqdm(total=len(members), desc="Organizing images") as progress, \
+            ThreadPoolExecutor(max_workers=extract_workers) as executor:
+        list(executor.map(extract_members, batches))
+    
+    return image_ids
+
+def diagnosis_columns(fieldnames, class_mapping):
+    """Validate the ground truth columns and return the diagnosis ones"""
+    # Check column names
+    print(f"CSV columns: {fieldnames}")
+    
+    if 'image' not in fieldnames:
+        raise ValueError(f"CSV file missing required 'image' column: {fieldnames}")
+    
+    class_columns = [abbrev for abbrev in class_mapping if abbrev in fieldnames]
+    if not class_columns:
+        raise ValueError(f"CSV file has no diagnosis columns: {fieldnames}")
+    return class_columns
+
+def read_ground_truth(ground_truth_path, class_mapping):
+    """
+    Return a dict mapping each image id in the ground truth CSV to the
+    diagnosis abbreviation with the highest probability
+    """
+    labels = {}
+    
+    if pd is not None:
+        ground_truth = pd.read_csv(ground_truth_path)
+        class_columns = diagnosis_columns(list(ground_truth.columns), class_mapping)
+        
+        # Determine the class with highest probability for every row at once
+        probs = ground_truth[class_columns].to_numpy(dtype=np.float32)
+        best_indices = probs.argmax(axis=1)
+        has_class = probs.max(axis=1) > 0
+        for image_id, best_index, labelled in zip(ground_truth['image'].to_numpy(), best_indices, has_class):
+            if labelled:
+                labels[image_id] = class_columns[best_index]
+        return labels
+    
+    with open(ground_truth_path, 'r', newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        class_columns = diagnosis_columns(reader.fieldnames or [], class_mapping)
+        
+        # Fetch all class columns (plus the id, so it is always a tuple) in one call
+        getter = operator.itemgetter(*class_columns, 'image')
+        class_range = range(len(class_columns))
+        for row in reader:
+            values = getter(row)
+            probs = [float(value) for value in values[:-1]]
+            best_index = max(class_range, key=probs.__getitem__)
+            if probs[best_index] > 0:
+                labels[values[-1]] = class_columns[best_index]
+    return labels
 
 def process_dataset():
     """Download and process the ISIC 2018 dataset"""
     # For simplicity, we'll just use the first dataset in our list
     dataset = DATASETS[0]
     
-    # Download image ZIP
+    # Download image and metadata ZIPs concurrently
     image_zip_path = os.path.join(TEMP_DIR, f"{dataset['name']}_images.zip")
-    download_file(dataset['image_url'], image_zip_path)
-    
-    # Download metadata ZIP
     metadata_zip_path = os.path.join(TEMP_DIR, f"{dataset['name']}_metadata.zip")
-    download_file(dataset['metadata_url'], metadata_zip_path)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        downloads = [
+            executor.submit(download_file, dataset['image_url'], image_zip_path),
+            executor.submit(download_file, dataset['metadata_url'], metadata_zip_path),
+        ]
+        for future in downloads:
+            future.result()
     
-    # Extract image ZIP
+    # Images are streamed out of their ZIP once the ground truth is known,
+    # the fallbacks below extract the whole archive here instead
     image_extract_path = os.path.join(TEMP_DIR, "images")
-    os.makedirs(image_extract_path, exist_ok=True)
-    extract_zip(image_zip_path, image_extract_path)
     
     # Extract metadata ZIP
     metadata_extract_path = os.path.join(TEMP_DIR, "metadata")
@@ -91,7 +248,6 @@ def process_dataset():
     
     # Process ground truth
     print("Organizing images by diagnosis...")
-    import csv
     
     # Map from abbreviated to full class names
     class_mapping = {
@@ -127,43 +283,30 @@ def process_dataset():
                             print(f"Found valid CSV file: {ground_truth_path}")
                             break
     
+    # Count images per class as they are written
+    class_counts = Counter()
+    
     # Process and organize images
     try:
-        with open(ground_truth_path, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            
-            # Check column names
-            fieldnames = reader.fieldnames
-            print(f"CSV columns: {fieldnames}")
-            
-            if not fieldnames or 'image' not in fieldnames:
-                raise ValueError(f"CSV file missing required 'image' column: {fieldnames}")
-            
-            # Continue with file processing
-            for row in tqdm(reader, desc="Organizing images"):
-                # Determine the class with highest probability
-                best_class = None
-                best_prob = 0
-                
-                for abbrev in class_mapping:
-                    if abbrev in row and float(row[abbrev]) > best_prob:
-                        best_prob = float(row[abbrev])
-                        best_class = abbrev
-                
-                if best_class:
-                    image_id = row['image']
-                    source_path = os.path.join(image_extract_path, "ISIC2018_Task3_Training_Input", f"{image_id}.jpg")
-                    if os.path.exists(source_path):
-                        target_dir = class_dirs[best_class]
-                        target_path = os.path.join(target_dir, f"{image_id}.jpg")
-                        
-                        # Copy the image file
-                        import shutil
-                        shutil.copy2(source_path, target_path)
+        labels = read_ground_truth(ground_truth_path, class_mapping)
+        
+        # Map each labelled image to its class directory
+        targets = {
+            image_id: os.path.join(class_dirs[best_class], f"{image_id}.jpg")
+            for image_id, best_class in labels.items()
+        }
+        
+        # Write only the needed images, directly into their class directories
+        extracted = extract_images(image_zip_path, targets)
+        class_counts.update(class_mapping[labels[image_id]] for image_id in extracted)
     except Exception as e:
         print(f"Error processing CSV: {e}")
         print("Trying alternative approach with our JSON metadata...")
         
+        # The fallbacks work from the fully extracted image archive
+        os.makedirs(image_extract_path, exist_ok=True)
+        extract_zip(image_zip_path, image_extract_path)
+        
         # Alternative: Use the JSON file we already have
         isic_metadata_path = 'isic_metadata.json'
         if os.path.exists(isic_metadata_path):
@@ -171,36 +314,38 @@ def process_dataset():
             with open(isic_metadata_path, 'r') as json_file:
                 metadata = json.load(json_file)
             
+            # Index the extracted images once instead of walking the tree per item
+            image_index = {}
+            for root, dirs, files in os.walk(image_extract_path):
+                for file in files:
+                    if file.endswith('.jpg'):
+                        image_index[os.path.splitext(file)[0]] = os.path.join(root, file)
+            
             # Process each image according to the JSON metadata
             for item in tqdm(metadata, desc="Organizing images"):
                 isic_id = item['isic_id']
                 diagnosis = item['diagnosis']
                 
                 # Find the image file
-                source_path = None
-                for root, dirs, files in os.walk(image_extract_path):
-                    for file in files:
-                        if file.startswith(isic_id) and file.endswith('.jpg'):
-                            source_path = os.path.join(root, file)
-                            break
-                    if source_path:
-                        break
+                source_path = image_index.get(isic_id)
                 
-                if source_path and os.path.exists(source_path):
+                if source_path:
                     # Make sure target directory exists
                     target_dir = os.path.join(OUTPUT_DIR, diagnosis)
                     os.makedirs(target_dir, exist_ok=True)
                     
                     # Copy file
                     target_path = os.path.join(target_dir, f"{isic_id}.jpg")
-                    import shutil
-                    shutil.copy2(source_path, target_path)
+                    try:
+                        fast_copy(source_path, target_path)
+                    except FileNotFoundError:
+                        continue
+                    class_counts[diagnosis] += 1
         else:
             print(f"No fallback metadata file found at {isic_metadata_path}")
             # Create dummy classes for demonstration
             print("Creating a small demonstration dataset with dummy classes")
             import random
-            import shutil
             
             # Get all image files
             all_image_files = []
@@ -220,18 +365,12 @@ def process_dataset():
                     # Copy file
                     filename = os.path.basename(file)
                     target_path = os.path.join(target_dir, filename)
-                    shutil.copy2(file, target_path)
+                    fast_copy(file, target_path)
+                    class_counts[class_name] += 1
     
     # Report results
-    class_counts = {}
-    for cls in os.listdir(OUTPUT_DIR):
-        class_dir = os.path.join(OUTPUT_DIR, cls)
-        if os.path.isdir(class_dir):
-            count = len([f for f in os.listdir(class_dir) if f.endswith('.jpg')])
-            class_counts[cls] = count
-    
     print("\nDataset successfully organized:")
-    for cls, count in sorted(class_counts.items(), key=lambda x: x[1], reverse=True):
+    for cls, count in class_counts.most_common():
         print(f"  {cls}: {count} images")
 
 if __name__ == "__main__":
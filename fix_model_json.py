@@ -1,6 +1,81 @@
-import json
 import os
 import sys
+from typing import List, Optional
+
+from utils import loads, dump_json
+
+# simdjson parses lazily, so only the first layer is ever materialized; msgspec
+# can instead decode just the fields the input layer check needs into typed
+# structs. Either skips building the rest of the document as Python objects.
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if msgspec is not None:
+    class InputLayerConfig(msgspec.Struct):
+        batch_input_shape: Optional[list] = None
+        batch_shape: Optional[list] = None  # Keras 3 name for the same shape
+
+    class Layer(msgspec.Struct):
+        class_name: Optional[str] = None
+        config: Optional[InputLayerConfig] = None
+
+    class TopologyConfig(msgspec.Struct):
+        layers: List[Layer] = []
+
+    class ModelConfig(msgspec.Struct):
+        config: Optional[TopologyConfig] = None
+
+    class Topology(msgspec.Struct):
+        config: Optional[TopologyConfig] = None
+        model_config: Optional[ModelConfig] = None  # Keras 3 TFJS layout
+
+    class ModelJson(msgspec.Struct):
+        modelTopology: Optional[Topology] = None  # TFJS layers format
+        config: Optional[TopologyConfig] = None  # Keras format
+
+def input_layer_is_valid(raw):
+    """
+    Check whether the first layer is already an InputLayer with an input
+    shape, decoding only the fields needed to tell
+    """
+    if simdjson is not None:
+        doc = simdjson.Parser().parse(raw)
+        topology = doc['modelTopology'] if 'modelTopology' in doc else doc
+        if 'model_config' in topology:
+            topology = topology['model_config']
+        try:
+            first_layer = topology.at_pointer('/config/layers/0')
+        except (KeyError, IndexError):
+            return False
+        
+        if first_layer.get('class_name') != 'InputLayer':
+            return False
+        config = first_layer.get('config')
+        return config is None or has_input_shape(config)
+    
+    model = msgspec.json.decode(raw, type=ModelJson)
+    topology = model.modelTopology if model.modelTopology is not None else model
+    if isinstance(topology, Topology) and topology.model_config is not None:
+        topology = topology.model_config
+    if topology.config is None or not topology.config.layers:
+        return False
+    
+    first_layer = topology.config.layers[0]
+    if first_layer.class_name != 'InputLayer':
+        return False
+    config = first_layer.config
+    return config is None or config.batch_input_shape is not None or config.batch_shape is not None
+
+def has_input_shape(config):
+    """Whether an InputLayer config carries its shape (Keras 2 or Keras 3 key)"""
+    return config.get('batch_input_shape') is not None or config.get('batch_shape') is not None
 
 def fix_model_json(model_json_path):
     """
@@ -10,9 +85,22 @@ def fix_model_json(model_json_path):
     
     # Load the existing model.json file
     try:
-        with open(model_json_path, 'r') as f:
-            model_json = json.load(f)
-            print("Model.json loaded successfully")
+        with open(model_json_path, 'rb') as f:
+            original_bytes = f.read()
+        
+        # Skip building the full document when there is nothing to fix
+        if simdjson is not None or msgspec is not None:
+            try:
+                if input_layer_is_valid(original_bytes):
+                    print("Model.json loaded successfully")
+                    print("No fixes needed for model.json")
+                    return True
+            except Exception:
+                # Unexpected structure, let the full parse below handle it
+                pass
+        
+        model_json = loads(original_bytes)
+        print("Model.json loaded successfully")
     except Exception as e:
         print(f"Error loading model.json: {str(e)}")
         return False
@@ -23,79 +111,69 @@ def fix_model_json(model_json_path):
     
     if is_tfjs_format:
         print("Detected TensorFlow.js layers model format")
-        model_config = model_json.get('modelTopology', {}).get('config', {})
-        layers = model_config.get('layers', [])
+        topology = model_json['modelTopology']
     else:
         print("Detected Keras model format")
-        model_config = model_json.get('config', {})
-        layers = model_config.get('layers', [])
+        topology = model_json
+    
+    # Keras 3 exports nest the functional config one level deeper
+    if 'model_config' in topology:
+        topology = topology['model_config']
     
-    # Check if layers exist and fix if needed
+    # Bind the layer list once; it is mutated in place below
+    config = topology.get('config')
+    layers = config.get('layers') if isinstance(config, dict) else None
+    
+    # Nothing can be fixed without layers, so leave the file alone
     if not layers:
         print("No layers found in model.json")
-        needs_fix = True
-        
-        # Create a minimal set of layers with proper input
-        if is_tfjs_format:
-            model_json['modelTopology']['config']['layers'] = []
-            layers = model_json['modelTopology']['config']['layers']
-        else:
-            model_json['config']['layers'] = []
-            layers = model_json['config']['layers']
+        return False
     
     # Check if first layer is InputLayer with proper shape
-    if layers and len(layers) > 0:
-        first_layer = layers[0]
+    first_layer = layers[0]
+    
+    if first_layer.get('class_name') != 'InputLayer':
+        print("First layer is not an InputLayer. Adding InputLayer...")
+        input_layer = {
+            "class_name": "InputLayer",
+            "config": {
+                "batch_input_shape": [None, 224, 224, 3],
+                "dtype": "float32",
+                "sparse": False,
+                "name": "input_1"
+            },
+            "name": "input_1",
+            "inbound_nodes": []
+        }
+        layers.insert(0, input_layer)
+        needs_fix = True
         
-        if first_layer.get('class_name') != 'InputLayer':
-            print("First layer is not an InputLayer. Adding InputLayer...")
-            input_layer = {
-                "class_name": "InputLayer",
-                "config": {
-                    "batch_input_shape": [None, 224, 224, 3],
-                    "dtype": "float32",
-                    "sparse": False,
-                    "name": "input_1"
-                },
-                "name": "input_1",
-                "inbound_nodes": []
-            }
-            layers.insert(0, input_layer)
-            needs_fix = True
-            
-            # Update inbound_nodes for second layer if needed
-            if len(layers) > 1 and 'inbound_nodes' in layers[1]:
-                if not layers[1]['inbound_nodes']:
-                    layers[1]['inbound_nodes'] = [[["input_1", 0, 0, {}]]]
-                    print("Updated inbound_nodes for second layer")
-        else:
-            # Check if InputLayer has batch_input_shape
-            if 'config' in first_layer and 'batch_input_shape' not in first_layer['config']:
-                print("InputLayer is missing batch_input_shape. Adding it...")
-                first_layer['config']['batch_input_shape'] = [None, 224, 224, 3]
-                first_layer['config']['input_shape'] = [224, 224, 3]
-                needs_fix = True
-            elif 'config' in first_layer and first_layer['config'].get('batch_input_shape') is None:
-                print("InputLayer has null batch_input_shape. Fixing it...")
-                first_layer['config']['batch_input_shape'] = [None, 224, 224, 3]
-                first_layer['config']['input_shape'] = [224, 224, 3]
-                needs_fix = True
+        # Update inbound_nodes for second layer if needed
+        if len(layers) > 1 and 'inbound_nodes' in layers[1]:
+            if not layers[1]['inbound_nodes']:
+                layers[1]['inbound_nodes'] = [[["input_1", 0, 0, {}]]]
+                print("Updated inbound_nodes for second layer")
+    elif 'config' in first_layer and not has_input_shape(first_layer['config']):
+        # Keras 3 stores the same shape as batch_shape, which counts too
+        print("InputLayer is missing batch_input_shape. Adding it...")
+        first_layer['config']['batch_input_shape'] = [None, 224, 224, 3]
+        first_layer['config']['input_shape'] = [224, 224, 3]
+        needs_fix = True
     
     # Save the fixed model.json if needed
     if needs_fix:
         # Backup the original file
         backup_path = model_json_path + '.backup'
         try:
-            with open(backup_path, 'w') as f:
-                json.dump(model_json, f)
+            with open(backup_path, 'wb') as f:
+                f.write(original_bytes)
             print(f"Original model.json backed up to {backup_path}")
         except Exception as e:
             print(f"Warning: Failed to create backup: {str(e)}")
         
         # Save the fixed model.json
         try:
-            with open(model_json_path, 'w') as f:
-                json.dump(model_json, f, indent=2)
+            dump_json(model_json, model_json_path, indent=True)
             print(f"Fixed model.json saved to {model_json_path}")
             return True
         except Exception as e:
@@ -1,42 +1,49 @@
-import json
 import os
 import glob
+import re
+
+from utils import load_json, dump_json
 
 # Check which weight files actually exist
 model_dir = 'model'
 weight_files = glob.glob(os.path.join(model_dir, '*.bin'))
 print(f"Found weight files: {weight_files}")
 
-# Detect pattern - do we have 3 shards or 5?
-shard3_pattern = [f for f in weight_files if 'shard1of3' in f]
-shard5_pattern = [f for f in weight_files if 'shard1of5' in f]
-
-# Determine which pattern to use
-use_pattern = 'of3' if shard3_pattern else 'of5'
-print(f"Using pattern: {use_pattern}")
+# Group the shards by export: group1-shard{i}of{n}.bin, keeping only complete sets
+shard_sets = {}
+for path in weight_files:
+    match = re.fullmatch(r'group1-shard(\d+)of(\d+)\.bin', os.path.basename(path))
+    if match:
+        shard_sets.setdefault(int(match.group(2)), set()).add(int(match.group(1)))
+complete_counts = sorted(n for n, shards in shard_sets.items() if shards == set(range(1, n + 1)))
+print(f"Complete shard sets: {[f'of{n}' for n in complete_counts]}")
 
 # Load model.json
-with open(os.path.join(model_dir, 'model.json'), 'r') as f:
-    model_json = json.load(f)
+model_json = load_json(os.path.join(model_dir, 'model.json'))
 
 # Update weightsManifest to use the correct pattern with relative paths
-if 'weightsManifest' in model_json:
-    shards = []
-    
-    if use_pattern == 'of3':
-        # Include relative path to model directory
-        shards = ['./model/group1-shard1of3.bin', './model/group1-shard2of3.bin', './model/group1-shard3of3.bin']
+if 'weightsManifest' in model_json and not complete_counts:
+    print("ERROR: No complete set of weight shards found")
+elif 'weightsManifest' in model_json:
+    # Prefer the set the manifest already names; otherwise the newest export
+    current = [os.path.basename(p) for p in model_json['weightsManifest'][0].get('paths', [])]
+    current_match = re.fullmatch(r'group1-shard\d+of(\d+)\.bin', current[0]) if current else None
+    if current_match and int(current_match.group(1)) in complete_counts:
+        shard_count = int(current_match.group(1))
     else:
-        shards = ['./model/group1-shard1of5.bin', './model/group1-shard2of5.bin', './model/group1-shard3of5.bin', 
-                  './model/group1-shard4of5.bin', './model/group1-shard5of5.bin']
+        shard_count = max(complete_counts, key=lambda n: os.path.getmtime(
+            os.path.join(model_dir, f'group1-shard1of{n}.bin')))
+    print(f"Using pattern: of{shard_count}")
+    
+    # Include relative path to model directory
+    shards = [f'./model/group1-shard{i}of{shard_count}.bin' for i in range(1, shard_count + 1)]
     
     # Update paths
     model_json['weightsManifest'][0]['paths'] = shards
     print(f"Updated weightsManifest to use: {shards}")
 
     # Save updated model.json
-    with open(os.path.join(model_dir, 'model.json'), 'w') as f:
-        json.dump(model_json, f, indent=2)
+    dump_json(model_json, os.path.join(model_dir, 'model.json'), indent=True)
     print("Updated model.json saved")
 else:
     print("ERROR: No weightsManifest found in model.json")
\ No newline at end of file
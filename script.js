@@ -172,6 +172,7 @@ async function loadModel() {
 function preprocessImage(imageElement) {
   return tf.tidy(() => {
     // Use standard image size of 224x224
+    // The exported model takes pixels in [0, 1] and rescales them itself
     const tensor = tf.browser.fromPixels(imageElement)
       .resizeNearestNeighbor([224, 224])
       .toFloat()
@@ -1,49 +1,112 @@
 import os
+import shutil
+import zlib
 import random
-import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
-import subprocess
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.applications import EfficientNetB0
-from tensorflow.keras.layers import GlobalAveragePooling2D, Dense, Dropout, Input, BatchNormalization
-from tensorflow.keras.models import Model
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import ReduceLROnPlateau, ModelCheckpoint, EarlyStopping
+from tensorflow.keras.layers import GlobalAveragePooling2D, Dense, Dropout, Input, BatchNormalization, Activation, Rescaling
+from tensorflow.keras.layers import RandomFlip, RandomRotation, RandomTranslation, RandomZoom, RandomBrightness, RandomContrast
+from tensorflow.keras.models import Model, Sequential
+from tensorflow.keras.optimizers import AdamW
+from tensorflow.keras import mixed_precision
+from tensorflow.keras.callbacks import Callback, ReduceLROnPlateau, EarlyStopping
+from utils import loads, load_json, dump_json
 
 # Enhanced configuration with better settings
 SEED = 42
 IMG_HEIGHT, IMG_WIDTH = 224, 224
-BATCH_SIZE = 64
+BATCH_SIZE = 128  # Fits once float16 halves activations; multiple of 8 for Tensor Cores
 EPOCHS = 10  # Increased epochs for better training
 DATASET_DIR = 'isic_dataset'
 VALIDATION_SPLIT = 0.15  # Reduced validation to have more training data
+SHARD_SIZE_BYTES = 100 * 1024 * 1024  # Target size of each TFRecord shard
 LEARNING_RATE = 1e-4
 FINE_TUNE_LEARNING_RATE = 5e-5
+WEIGHT_DECAY = 1e-5
 
 # Set random seeds for reproducibility
 random.seed(SEED)
 tf.random.set_seed(SEED)
 os.environ['PYTHONHASHSEED'] = str(SEED)
 
+# Run convolutions in float16 on Tensor Core GPUs, keeping float32 weights
+mixed_precision.set_global_policy('mixed_float16')
+
+# Replicate the model on every visible GPU; each step's batch is split across
+# replicas, so the global batch and learning rates scale with their count
+strategy = tf.distribute.MirroredStrategy()
+NUM_REPLICAS = strategy.num_replicas_in_sync
+GLOBAL_BATCH_SIZE = BATCH_SIZE * NUM_REPLICAS
+print(f"Training on {NUM_REPLICAS} replica(s), global batch size {GLOBAL_BATCH_SIZE}")
+
 print("Setting up data directories...")
 
-TRAIN_DIR = os.path.join(DATASET_DIR, 'train')
-VAL_DIR = os.path.join(DATASET_DIR, 'val')
+TFRECORD_DIR = os.path.join(DATASET_DIR, 'tfrecords')
+CLASS_NAMES_PATH = os.path.join(TFRECORD_DIR, 'class_names.json')
+SNAPSHOT_DIR = os.path.join(DATASET_DIR, 'snapshots')
+FEATURE_CACHE_DIR = os.path.join(DATASET_DIR, 'features')
 
-os.makedirs(TRAIN_DIR, exist_ok=True)
-os.makedirs(VAL_DIR, exist_ok=True)
+os.makedirs(TFRECORD_DIR, exist_ok=True)
 os.makedirs('model', exist_ok=True)
 
+def shard_paths(split):
+    """Return the sorted TFRecord shard paths written for a split"""
+    return sorted(tf.io.gfile.glob(os.path.join(TFRECORD_DIR, f"{split}-*.tfrecord")))
+
+def write_tfrecord_shards(split, examples):
+    """
+    Pack (image path, label) examples into TFRecord shards of roughly
+    SHARD_SIZE_BYTES each, so training reads a few large files sequentially
+    """
+    for path in shard_paths(split):
+        os.remove(path)
+    
+    # Shards are filled one after another and renamed once their count is
+    # known, so no file has to be stat'ed up front
+    temp_paths = []
+    writer = None
+    shard_bytes = 0
+    for path, label in examples:
+        if writer is None or shard_bytes >= SHARD_SIZE_BYTES:
+            if writer is not None:
+                writer.close()
+            temp_paths.append(os.path.join(TFRECORD_DIR, f"{split}-{len(temp_paths):05d}.tmp"))
+            writer = tf.io.TFRecordWriter(temp_paths[-1])
+            shard_bytes = 0
+        
+        # Store the original JPEG bytes, they are decoded at training time
+        with open(path, 'rb') as f:
+            encoded = f.read()
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'image/encoded': tf.train.Feature(bytes_list=tf.train.BytesList(value=[encoded])),
+            'image/class/label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+        }))
+        writer.write(example.SerializeToString())
+        shard_bytes += len(encoded)
+    if writer is not None:
+        writer.close()
+    
+    num_shards = len(temp_paths)
+    for shard, temp_path in enumerate(temp_paths):
+        os.rename(temp_path, os.path.join(TFRECORD_DIR, f"{split}-{shard:05d}-of-{num_shards:05d}.tfrecord"))
+    
+    print(f"Wrote {len(examples)} {split} images to {num_shards} TFRecord shards")
+
 def split_data_into_train_val():
     """
-    Creates train and validation directories with class subdirectories
+    Splits every class into train and validation sets and writes each set
+    as sharded TFRecord files
     """
     print("Organizing data into train/validation splits...")
     
     # Get all diagnosis folders
-    class_dirs = [d for d in os.listdir(DATASET_DIR) 
-                  if os.path.isdir(os.path.join(DATASET_DIR, d)) 
-                  and d not in ['train', 'val']]
+    generated_dirs = ['train', 'val', os.path.basename(TFRECORD_DIR), os.path.basename(SNAPSHOT_DIR),
+                      os.path.basename(FEATURE_CACHE_DIR)]
+    with os.scandir(DATASET_DIR) as entries:
+        class_dirs = sorted(e.name for e in entries
+                            if e.is_dir() and e.name not in generated_dirs)
     
     if not class_dirs:
         print("No class directories found! Please run dataset.py first.")
@@ -51,17 +114,13 @@ def split_data_into_train_val():
     
     # Track class counts for balancing
     class_counts = {}
-    for class_dir in class_dirs:
-        # Create class directory in train and val
-        train_class_dir = os.path.join(TRAIN_DIR, class_dir)
-        val_class_dir = os.path.join(VAL_DIR, class_dir)
-        
-        os.makedirs(train_class_dir, exist_ok=True)
-        os.makedirs(val_class_dir, exist_ok=True)
-        
+    train_examples, val_examples = [], []
+    for label, class_dir in enumerate(class_dirs):
         # Get all image files
         source_dir = os.path.join(DATASET_DIR, class_dir)
-        image_files = [f for f in os.listdir(source_dir) if f.endswith('.jpg')]
+        with os.scandir(source_dir) as entries:
+            image_files = [(e.path, label) for e in entries
+                           if e.is_file(follow_symlinks=False) and e.name.endswith('.jpg')]
         
         class_counts[class_dir] = len(image_files)
         
@@ -70,36 +129,32 @@ def split_data_into_train_val():
             print(f"Warning: No images found in {source_dir}")
             continue
             
-        # Shuffle files
-        random.shuffle(image_files)
-        
-        # Split into train and validation
-        split_idx = int(len(image_files) * (1 - VALIDATION_SPLIT))
-        train_files = image_files[:split_idx]
-        val_files = image_files[split_idx:]
+        # Split into train and validation by a stable hash of the file name, so
+        # an image always lands in the same split regardless of listing order
+        train_files, val_files = [], []
+        for example in image_files:
+            bucket = zlib.crc32(os.path.basename(example[0]).encode('utf-8')) % 100
+            if bucket < VALIDATION_SPLIT * 100:
+                val_files.append(example)
+            else:
+                train_files.append(example)
         
         print(f"{class_dir}: {len(train_files)} train, {len(val_files)} validation images")
         
-        # Create symbolic links (or copy if symlinks not supported)
-        for f in train_files:
-            src = os.path.join(source_dir, f)
-            dst = os.path.join(train_class_dir, f)
-            if not os.path.exists(dst):
-                try:
-                    os.symlink(os.path.abspath(src), dst)
-                except (OSError, NotImplementedError):
-                    import shutil
-                    shutil.copy2(src, dst)
-        
-        for f in val_files:
-            src = os.path.join(source_dir, f)
-            dst = os.path.join(val_class_dir, f)
-            if not os.path.exists(dst):
-                try:
-                    os.symlink(os.path.abspath(src), dst)
-                except (OSError, NotImplementedError):
-                    import shutil
-                    shutil.copy2(src, dst)
+        train_examples.extend(train_files)
+        val_examples.extend(val_files)
+    
+    # Decoded snapshots and cached features of an older split would no longer
+    # match the shards
+    shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+    shutil.rmtree(FEATURE_CACHE_DIR, ignore_errors=True)
+    
+    # Mix classes so every shard holds a sample of all of them
+    random.shuffle(train_examples)
+    write_tfrecord_shards('train', train_examples)
+    write_tfrecord_shards('val', val_examples)
+    
+    dump_json(class_dirs, CLASS_NAMES_PATH)
     
     # Print class distribution
     print("\nClass distribution:")
@@ -108,102 +163,313 @@ def split_data_into_train_val():
     
     return True
 
-# Enhanced data augmentation for better model generalization
-def create_data_generators():
-    """Create train and validation data generators with augmentation"""
-    
-    train_datagen = ImageDataGenerator(
-        rescale=1./255,
-        rotation_range=30,  # Increased rotation
-        width_shift_range=0.2,
-        height_shift_range=0.2,
-        zoom_range=0.3,  # Increased zoom
-        horizontal_flip=True,
-        vertical_flip=True,
-        shear_range=0.1,  # Added shear
-        brightness_range=[0.8, 1.2],  # Added brightness variation
-        fill_mode='nearest'
+def load_tfrecord_dataset(split, num_classes, shuffle=False):
+    """
+    Build an unbatched (image, one-hot label) dataset from a split's TFRecord
+    shards, reading shards and decoding images in parallel
+    """
+    feature_spec = {
+        'image/encoded': tf.io.FixedLenFeature([], tf.string),
+        'image/class/label': tf.io.FixedLenFeature([], tf.int64),
+    }
+    
+    def parse(serialized):
+        example = tf.io.parse_single_example(serialized, feature_spec)
+        encoded = example['image/encoded']
+        
+        # Images at least twice the target size are downscaled by the JPEG
+        # decoder itself, which skips most of the IDCT work
+        shape = tf.image.extract_jpeg_shape(encoded)
+        image = tf.cond(
+            tf.logical_and(shape[0] >= 2 * IMG_HEIGHT, shape[1] >= 2 * IMG_WIDTH),
+            lambda: tf.io.decode_jpeg(encoded, channels=3, ratio=2, dct_method='INTEGER_FAST'),
+            lambda: tf.io.decode_jpeg(encoded, channels=3, dct_method='INTEGER_FAST')
+        )
+        # Stay uint8 until the model, which normalizes on the accelerator
+        image = tf.image.resize(image, (IMG_HEIGHT, IMG_WIDTH))
+        image = tf.saturate_cast(tf.round(image), tf.uint8)
+        return image, tf.one_hot(example['image/class/label'], num_classes)
+    
+    paths = shard_paths(split)
+    files = tf.data.Dataset.from_tensor_slices(paths)
+    if shuffle:
+        files = files.shuffle(len(paths), seed=SEED)
+    # Read several shards at once with large sequential reads, yielding records
+    # from whichever shard is ready first
+    ds = files.interleave(
+        lambda path: tf.data.TFRecordDataset(path, buffer_size=8 * 1024 * 1024),
+        cycle_length=tf.data.AUTOTUNE,
+        block_length=16,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=False
     )
+    ds = ds.map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+    
+    # Give the pipeline its own threads instead of sharing TensorFlow's pool
+    options = tf.data.Options()
+    options.threading.private_threadpool_size = os.cpu_count()
+    return ds.with_options(options)
 
-    # Only rescaling for validation
-    val_datagen = ImageDataGenerator(rescale=1./255)
-
+# Enhanced data augmentation for better model generalization
+def create_datasets():
+    """Create train and validation tf.data pipelines with augmentation"""
+    
+    # Augmentation runs on whole batches inside the input pipeline, so the
+    # exported model stays free of training-only layers. The layers compute in
+    # float32 on the host regardless of the global mixed precision policy.
+    augmentation = Sequential([
+        RandomFlip('horizontal_and_vertical', dtype='float32'),
+        RandomRotation(30 / 360, fill_mode='nearest', dtype='float32'),  # Increased rotation
+        RandomTranslation(0.2, 0.2, fill_mode='nearest', dtype='float32'),
+        RandomZoom(0.3, fill_mode='nearest', dtype='float32'),  # Increased zoom
+        RandomBrightness(0.2, value_range=(0, 255), dtype='float32'),  # Added brightness variation
+        RandomContrast(0.2, dtype='float32')
+    ], name='augmentation')
+    
+    @tf.function
+    def augment(images, labels):
+        images = augmentation(tf.cast(images, tf.float32), training=True)
+        return tf.saturate_cast(tf.round(images), tf.uint8), labels
+    
+    class_names = load_json(CLASS_NAMES_PATH)
+    
     print("Loading training data...")
-    train_generator = train_datagen.flow_from_directory(
-        TRAIN_DIR,
-        target_size=(IMG_HEIGHT, IMG_WIDTH),
-        batch_size=BATCH_SIZE,
-        class_mode='categorical',
-        shuffle=True
+    # Decoded and resized images are snapshotted to disk on the first pass, so
+    # later epochs and runs skip JPEG decoding. Shuffling and augmentation come
+    # after the snapshot so it stays deterministic.
+    decoded_train_ds = load_tfrecord_dataset('train', len(class_names), shuffle=True).snapshot(
+        os.path.join(SNAPSHOT_DIR, 'train'),
+        compression='AUTO'
+    )
+    # Only used for inference (feature extraction), so it can take the larger
+    # validation batch size
+    plain_train_ds = (
+        decoded_train_ds
+        .batch(GLOBAL_BATCH_SIZE * 2)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+    train_ds = (
+        decoded_train_ds
+        .shuffle(10000, seed=SEED, reshuffle_each_iteration=True)
+        .batch(GLOBAL_BATCH_SIZE)
+        .map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+        .prefetch(tf.data.AUTOTUNE)
     )
 
+    # No augmentation for validation. It is deterministic, so it is cached
+    # once, and without backprop it can run at twice the training batch size
     print("Loading validation data...")
-    validation_generator = val_datagen.flow_from_directory(
-        VAL_DIR,
-        target_size=(IMG_HEIGHT, IMG_WIDTH),
-        batch_size=BATCH_SIZE,
-        class_mode='categorical',
-        shuffle=False
+    val_ds = (
+        load_tfrecord_dataset('val', len(class_names))
+        .cache()
+        .batch(GLOBAL_BATCH_SIZE * 2)
+        .prefetch(tf.data.AUTOTUNE)
     )
     
-    return train_generator, validation_generator
+    return train_ds, plain_train_ds, val_ds, class_names
 
-def build_and_train_model(train_generator, validation_generator):
-    """Build and train the model with a two-phase approach"""
-    
-    # Determine number of classes dynamically
-    num_classes = len(train_generator.class_indices)
-    print(f"Training with {num_classes} classes: {train_generator.class_indices}")
-    
-    # Save class names immediately
-    class_indices = train_generator.class_indices
-    class_names = {str(v): k for k, v in class_indices.items()}
-    with open('model/class_names.json', 'w') as f:
-        json.dump(class_names, f)
-    
+def extract_features(feature_extractor, ds, split, backbone):
+    """
+    Run the frozen backbone over a dataset once, returning (features, labels).
+    The result is cached on disk, keyed by split, backbone and image size, so
+    later runs with the same settings skip the backbone.
+    """
+    cache_path = os.path.join(FEATURE_CACHE_DIR, f"{split}-{backbone}-{IMG_HEIGHT}x{IMG_WIDTH}.npz")
+    if os.path.exists(cache_path):
+        print(f"Loading cached {split} features from {cache_path}")
+        with np.load(cache_path) as cached:
+            return cached['features'], cached['labels']
+    
+    # Call the model directly rather than through predict_on_batch: under
+    # MirroredStrategy that runs the whole batch on every replica and
+    # concatenates the copies, giving more feature rows than labels
+    @tf.function
+    def extract(images):
+        return feature_extractor(images, training=False)
+    
+    features, labels = [], []
+    for images, batch_labels in ds:
+        features.append(extract(images).numpy())
+        labels.append(batch_labels.numpy())
+    features = np.concatenate(features)
+    labels = np.concatenate(labels)
+    
+    # Write to a temporary file first so an interrupted run can't leave a
+    # truncated cache behind
+    os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, features=features, labels=labels)
+    os.replace(temp_path, cache_path)
+    return features, labels
+
+class AsyncCheckpoint(Callback):
+    """
+    Checkpoint the weights whenever the monitored metric improves, writing them
+    on a background thread so the next epoch doesn't wait on the disk. Only the
+    latest best file is kept.
+    
+    snapshot_model is the model whose weights are saved, by default the one
+    being trained. Files hold get_weights() as arr_0, arr_1, ...; restore them
+    with snapshot_model.set_weights() once its layers have the same trainable
+    flags as during that phase.
+    """
+    def __init__(self, filepath, snapshot_model=None, monitor='val_accuracy', mode='max'):
+        super().__init__()
+        self.filepath = filepath
+        self.snapshot_model = snapshot_model
+        self.monitor = monitor
+        self.mode = mode
+        self.best = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.last_path = None
+    
+    def on_epoch_end(self, epoch, logs=None):
+        current = (logs or {}).get(self.monitor)
+        if current is None:
+            return
+        if self.best is not None and (current <= self.best if self.mode == 'max' else current >= self.best):
+            return
+        self.best = current
+        
+        # Copy the weights to host memory now; training keeps updating the
+        # variables while the file is written
+        weights = (self.snapshot_model or self.model).get_weights()
+        path = self.filepath.format(epoch=epoch + 1)
+        self.pending.append(self.executor.submit(self._write, weights, path, self.last_path))
+        self.last_path = path
+    
+    def on_train_end(self, logs=None):
+        for future in self.pending:
+            future.result()
+        self.executor.shutdown()
+    
+    @staticmethod
+    def _write(weights, path, previous_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, *weights)
+        
+        # Writes run one at a time, so the previous best is complete by now
+        if previous_path is not None and previous_path != path and os.path.exists(previous_path):
+            os.remove(previous_path)
+
+def build_model(num_classes, weights='imagenet', input_scale=None):
+    """
+    Build the EfficientNetB0 classifier under the current dtype policy.
+    Returns the full model, its backbone, the backbone + pooling feature
+    extractor and a head over pooled features that shares the model's top layers.
+    With input_scale, inputs are multiplied by it before reaching the backbone.
+    """
     print("Building EfficientNetB0 model...")
     # EXPLICITLY create input layer first - this is key for correct model.json format
     inputs = Input(shape=(IMG_HEIGHT, IMG_WIDTH, 3), name="input_layer")
     
-    # Initialize the base model with pre-trained weights
+    # Initialize the base model with pre-trained weights. It gets its own
+    # input and is called on ours exactly once below; passing
+    # input_tensor=inputs as well would wire the backbone in twice
     base_model = EfficientNetB0(
-        weights='imagenet',
+        weights=weights,
         include_top=False,
-        input_tensor=inputs  # Use our explicit input tensor
+        input_shape=(IMG_HEIGHT, IMG_WIDTH, 3)
     )
     
     # Freeze the base model initially
     base_model.trainable = False
     
-    # Add custom classification layers
-    x = base_model(inputs, training=False)
-    x = GlobalAveragePooling2D()(x)
-    x = BatchNormalization()(x)
-    x = Dense(256, activation='relu')(x)
-    x = Dropout(0.5)(x)  # Increased dropout for better generalization
-    x = Dense(128, activation='relu')(x)
-    x = Dropout(0.3)(x)
-    outputs = Dense(num_classes, activation='softmax')(x)
-    
-    # Create the initial model
-    model = Model(inputs=inputs, outputs=outputs)
-    
-    # Compile the initial model
-    model.compile(
-        optimizer=Adam(learning_rate=LEARNING_RATE),
-        loss='categorical_crossentropy',
-        metrics=['accuracy']
-    )
+    # Custom classification layers, shared by the feature-only head and the full model
+    head_layers = [
+        BatchNormalization(),
+        Dense(256, activation='relu'),
+        Dropout(0.5),  # Increased dropout for better generalization
+        Dense(128, activation='relu'),
+        Dropout(0.3),
+        # Keep the logits and softmax in float32 for numerical stability
+        Dense(num_classes, dtype='float32'),
+        Activation('softmax', dtype='float32')
+    ]
+    
+    def apply_head(x):
+        for layer in head_layers:
+            x = layer(x)
+        return x
+    
+    # The backbone takes [0, 255] pixels, which is what EfficientNet expects:
+    # its own preprocessing layers rescale and normalize them
+    x = Rescaling(input_scale)(inputs) if input_scale is not None else inputs
+    features = base_model(x, training=False)
+    features = GlobalAveragePooling2D()(features)
+    feature_extractor = Model(inputs=inputs, outputs=features)
+    
+    # Create the full model
+    model = Model(inputs=inputs, outputs=apply_head(features))
     
     # Explicitly set input shape info
     input_shape = model.input_shape
     print(f"Model input shape: {input_shape}")
     
+    feature_inputs = Input(shape=features.shape[1:], name="features")
+    head = Model(inputs=feature_inputs, outputs=apply_head(feature_inputs))
+    
+    return model, base_model, feature_extractor, head
+
+def build_float32_copy(model, num_classes):
+    """
+    Rebuild the model under a float32 policy and copy the trained weights in,
+    so exports carry no float16 compute, casts or mixed_float16 dtype policies.
+    The copy takes [0, 1] pixels, the input contract of the deployed web app.
+    """
+    mixed_precision.set_global_policy('float32')
+    try:
+        # Rescaling has no weights, so the weight lists still line up
+        export_model = build_model(num_classes, weights=None, input_scale=255.0)[0]
+    finally:
+        mixed_precision.set_global_policy('mixed_float16')
+    
+    # Weights are listed trainable first, so both models need the same
+    # trainable flags for get_weights/set_weights to line up
+    model.trainable = True
+    export_model.trainable = True
+    export_model.set_weights(model.get_weights())
+    return export_model
+
+def build_and_train_model(train_ds, plain_train_ds, val_ds, class_names):
+    """Build and train the model with a two-phase approach"""
+    
+    # Determine number of classes dynamically
+    num_classes = len(class_names)
+    print(f"Training with {num_classes} classes: {class_names}")
+    
+    # Save class names immediately
+    dump_json({str(i): name for i, name in enumerate(class_names)}, 'model/class_names.json')
+    
+    # Variables must be created under the strategy to be mirrored
+    with strategy.scope():
+        model, base_model, feature_extractor, head = build_model(num_classes)
+        
+        # Compile the head
+        head.compile(
+            optimizer=mixed_precision.LossScaleOptimizer(AdamW(learning_rate=LEARNING_RATE * NUM_REPLICAS, weight_decay=WEIGHT_DECAY)),
+            loss='categorical_crossentropy',
+            metrics=['accuracy'],
+            jit_compile=True  # Fuse ops into XLA kernels
+        )
+    
+    # The frozen backbone gives the same output every epoch, so run it once and
+    # train the head on the cached embeddings
+    print("Extracting backbone features...")
+    train_features, train_labels = extract_features(feature_extractor, plain_train_ds, 'train', base_model.name)
+    val_features, val_labels = extract_features(feature_extractor, val_ds, 'val', base_model.name)
+    
     # Callbacks for training
     callbacks = [
-        ModelCheckpoint(
-            'best_model_phase1.h5',
-            save_best_only=True,
+        # Weights only, kept for crash recovery; EarlyStopping restores the
+        # best weights in memory
+        AsyncCheckpoint(
+            'ckpt/phase1-{epoch:02d}.npz',
+            # The head is what trains, but save the full model it shares
+            # layers with so the file restores into it
+            snapshot_model=model,
             monitor='val_accuracy',
             mode='max'
         ),
@@ -222,15 +488,18 @@ def build_and_train_model(train_generator, validation_generator):
     
     # Phase 1: Train only the top layers
     print("Phase 1: Training top layers...")
-    history_phase1 = model.fit(
-        train_generator,
+    history_phase1 = head.fit(
+        train_features,
+        train_labels,
+        batch_size=GLOBAL_BATCH_SIZE,
         epochs=10,  # Fewer epochs for initial phase
-        validation_data=validation_generator,
-        callbacks=callbacks
+        validation_data=(val_features, val_labels),
+        callbacks=callbacks,
+        shuffle=True
     )
     
-    # Load the best weights from phase 1
-    model.load_weights('best_model_phase1.h5')
+    # EarlyStopping has already restored the best phase 1 weights, which the
+    # full model shares with the head
     
     # Phase 2: Fine-tune the model by unfreezing some layers
     print("\nPhase 2: Fine-tuning the model...")
@@ -243,18 +512,26 @@ def build_and_train_model(train_generator, validation_generator):
     for layer in base_model.layers[:-20]:  # Keep bottom layers frozen
         layer.trainable = False
     
+    # Keep BatchNormalization frozen too, following the Keras EfficientNet
+    # fine-tuning recipe: with training=False only the moving statistics are
+    # fixed, and this also stops gamma/beta from training on a small dataset
+    for layer in base_model.layers[-20:]:
+        if isinstance(layer, BatchNormalization):
+            layer.trainable = False
+    
     # Recompile with lower learning rate
-    model.compile(
-        optimizer=Adam(learning_rate=FINE_TUNE_LEARNING_RATE),
-        loss='categorical_crossentropy',
-        metrics=['accuracy']
-    )
+    with strategy.scope():
+        model.compile(
+            optimizer=mixed_precision.LossScaleOptimizer(AdamW(learning_rate=FINE_TUNE_LEARNING_RATE * NUM_REPLICAS, weight_decay=WEIGHT_DECAY)),
+            loss='categorical_crossentropy',
+            metrics=['accuracy'],
+            jit_compile=True  # Fuse ops into XLA kernels
+        )
     
     # Updated callbacks for phase 2
     callbacks = [
-        ModelCheckpoint(
-            'best_model_phase2.h5',
-            save_best_only=True,
+        AsyncCheckpoint(
+            'ckpt/phase2-{epoch:02d}.npz',
             monitor='val_accuracy',
             mode='max'
         ),
@@ -273,16 +550,13 @@ def build_and_train_model(train_generator, validation_generator):
     
     # Train with unfrozen layers
     history_phase2 = model.fit(
-        train_generator,
+        train_ds,
         epochs=EPOCHS,
-        validation_data=validation_generator,
+        validation_data=val_ds,
         callbacks=callbacks,
         initial_epoch=len(history_phase1.history['loss'])  # Continue from phase 1
     )
     
-    # Load the best weights from phase 2
-    model.load_weights('best_model_phase2.h5')
-    
     return model
 
 def save_model(model):
@@ -291,14 +565,10 @@ def save_model(model):
     print("Saving model in Keras format...")
     model.save('skin_model.keras')
     
-    # Also save as HDF5 for backward compatibility
-    print("Also saving model in HDF5 format...")
-    model.save('skin_model.h5')
-    
     # Manual creation of model.json with explicit input shape
     print("Creating explicit model.json with input shape...")
     model_json_str = model.to_json()
-    model_dict = json.loads(model_json_str)
+    model_dict = loads(model_json_str)
     
     # Ensure the first layer includes input shape info
     if "config" in model_dict and "layers" in model_dict["config"] and len(model_dict["config"]["layers"]) > 0:
@@ -320,27 +590,20 @@ def save_model(model):
             }
             model_dict["config"]["layers"].insert(0, input_layer)
     
-    with open('model/model.json', 'w') as f:
-        json.dump(model_dict, f)
+    dump_json(model_dict, 'model/model.json')
     
     print("\nConverting model to TensorFlow.js format...")
     try:
-        # Run conversion with essential flags
-        result = subprocess.run(
-            ["tensorflowjs_converter",
-             "--input_format=keras",
-             "--output_format=tfjs_layers_model",
-             "skin_model.h5",
-             "model/"],
-            check=True, 
-            capture_output=True, 
-            text=True
-        )
+        # Convert the in-memory model directly, reusing the loaded TensorFlow
+        # instead of starting tensorflowjs_converter on an HDF5 copy
+        from tensorflowjs.converters import save_keras_model
+        
+        # FP16 weights halve the browser download
+        save_keras_model(model, 'model/', quantization_dtype_map={'float16': '*'})
         print("Conversion successful!")
         
         # Open the converted model.json
-        with open('model/model.json', 'r') as f:
-            tfjs_model = json.load(f)
+        tfjs_model = load_json('model/model.json')
         
         # FIX: Update weightsManifest paths to include only file names (remove any directory info)
         if "weightsManifest" in tfjs_model:
@@ -374,21 +637,16 @@ def save_model(model):
                     first_layer['config']['batch_input_shape'] = [None, IMG_HEIGHT, IMG_WIDTH, 3]
                     needs_fixing = True
             if needs_fixing:
-                with open('model/model.json', 'w') as f:
-                    json.dump(tfjs_model, f)
+                dump_json(tfjs_model, 'model/model.json')
                 print("Fixed TFJS model.json with proper input shape")
         
-    except subprocess.CalledProcessError as e:
-        print("Conversion failed with error:")
-        print(e.stderr)
-        # (Alternate conversion and manual fix code can go here if needed.)
-    except FileNotFoundError:
-        print("tensorflowjs_converter not found. Please install it with:")
+    except ImportError:
+        print("tensorflowjs not found. Please install it with:")
         print("pip install tensorflowjs")
         # Fallback: Create a minimal model.json
         try:
             print("Creating minimal model.json for fallback...")
-            model_dict = json.loads(model.to_json())
+            model_dict = loads(model.to_json())
             tfjs_model = {
                 "format": "layers-model",
                 "generatedBy": "manual-fix",
@@ -420,15 +678,72 @@ def save_model(model):
                     }
                     layers.insert(0, input_layer)
             os.makedirs('model', exist_ok=True)
-            with open('model/model.json', 'w') as f:
-                json.dump(tfjs_model, f)
+            dump_json(tfjs_model, 'model/model.json')
             print("Created minimal model.json for fallback")
         except Exception as e4:
             print(f"Failed to create minimal model.json: {str(e4)}")
+    except Exception as e:
+        print(f"Conversion failed with error: {str(e)}")
+
+def save_tflite_model(model, representative_ds, num_samples=100):
+    """Convert the model to a fully int8-quantized TFLite model"""
+    
+    print("\nConverting model to int8 TensorFlow Lite format...")
+    
+    def representative_dataset():
+        # Calibrate activation ranges on un-augmented images, one at a time,
+        # scaled to the [0, 1] input the exported model takes
+        for images, _ in representative_ds.unbatch().batch(1).take(num_samples):
+            yield [tf.cast(images, tf.float32) / 255.0]
+    
+    try:
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        tflite_model = converter.convert()
+        
+        with open('skin_model.tflite', 'wb') as f:
+            f.write(tflite_model)
+        print(f"Saved int8 model to skin_model.tflite ({len(tflite_model) / 1024 / 1024:.1f} MB)")
+    except Exception as e:
+        print(f"TFLite conversion failed: {str(e)}")
+
+def save_tensorrt_model(model, saved_model_dir='skin_model_savedmodel', output_dir='skin_model_trt'):
+    """Convert the model to an FP16 TF-TRT SavedModel for server-side inference"""
+    
+    print("\nConverting model to TensorRT (FP16)...")
+    try:
+        # TF-TRT converts from a SavedModel rather than a Keras model
+        if hasattr(model, 'export'):
+            model.export(saved_model_dir)
+        else:
+            tf.saved_model.save(model, saved_model_dir)
+        
+        converter = tf.experimental.tensorrt.Converter(
+            input_saved_model_dir=saved_model_dir,
+            conversion_params=tf.experimental.tensorrt.ConversionParams(
+                precision_mode='FP16',
+                maximum_cached_engines=1
+            )
+        )
+        converter.convert()
+        
+        # Build the engine ahead of time for single-image requests
+        def input_fn():
+            yield (tf.zeros((1, IMG_HEIGHT, IMG_WIDTH, 3), tf.float32),)
+        
+        converter.build(input_fn=input_fn)
+        converter.save(output_dir)
+        print(f"Saved TensorRT model to {output_dir}/")
+    except Exception as e:
+        # TensorRT is only available in GPU builds of TensorFlow
+        print(f"TensorRT conversion failed: {str(e)}")
 
 if __name__ == "__main__":
     # First, ensure we have the train/val split
-    if not os.listdir(TRAIN_DIR) or not os.listdir(VAL_DIR):
+    if not shard_paths('train') or not shard_paths('val') or not os.path.exists(CLASS_NAMES_PATH):
         success = split_data_into_train_val()
         if not success:
             print("Error creating train/val split. Exiting.")
@@ -436,13 +751,20 @@ if __name__ == "__main__":
     else:
         print("Train/validation split already exists.")
     
-    # Create data generators
-    train_generator, validation_generator = create_data_generators()
+    # Create input pipelines
+    train_ds, plain_train_ds, val_ds, class_names = create_datasets()
     
     # Build and train the model
-    model = build_and_train_model(train_generator, validation_generator)
+    model = build_and_train_model(train_ds, plain_train_ds, val_ds, class_names)
+    
+    # Export a float32 copy that takes [0, 1] pixels: the int8 TFLite quantizer
+    # can't handle float16 compute, the browser model shouldn't carry
+    # mixed_float16 policies, and script.js sends [0, 1] input
+    export_model = build_float32_copy(model, len(class_names))
     
     # Save the model (and convert to TFJS format)
-    save_model(model)
+    save_model(export_model)
+    save_tflite_model(export_model, val_ds)
+    save_tensorrt_model(export_model)
     
     print("\nTraining and conversion complete!")
\ No newline at end of file
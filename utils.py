@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+
+# orjson parses and serializes large model.json files several times faster
+# than the stdlib, but fall back to json when it isn't installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """Parse JSON from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent=False):
+    """Serialize obj to UTF-8 encoded JSON bytes, optionally with 2-space indent"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None).encode('utf-8')
+
+
+def load_json(path):
+    """Read and parse a JSON file"""
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def dump_json(obj, path, indent=False):
+    """Serialize obj and write it to a JSON file"""
+    with open(path, 'wb') as f:
+        f.write(dumps(obj, indent=indent))
+
+
+def fast_copy(src, dst):
+    """
+    Place a copy of src at dst without duplicating the data where possible.
+    Tries a hardlink first, then an in-kernel copy_file_range, and finally
+    falls back to shutil.copy2. An existing dst is left untouched.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except FileExistsError:
+        return
+    except OSError:
+        pass
+
+    created = False
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+            created = True
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        shutil.copystat(src, dst)
+        return
+    except FileExistsError:
+        return
+    except (OSError, AttributeError):
+        # copy_file_range is Linux-only; drop any partial file this call
+        # created before falling back
+        if created:
+            os.remove(dst)
+
+    shutil.copy2(src, dst)